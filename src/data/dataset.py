@@ -3,59 +3,261 @@ Cityscapes 配对数据集（已分割的 label/photo）。
 
 - 读取 `data/processed/{split}/{label,photo}`。
 - 支持外部传入 transform(label, photo) -> (label_t, photo_t)。
+- gpu_decode=True 时 photo JPEG 通过 nvJPEG 在 GPU 上解码（返回 uint8 CHW CUDA tensor），
+  label PNG 仍在 CPU 上解码；此时 DataLoader 需使用 num_workers=0，且必须传入 transform。
+- use_turbojpeg=True 时 photo 由 PyTurboJPEG（libjpeg-turbo）直接解码为 uint8 数组（不经过 PIL），默认走 PIL。
+- 有 transform 时 photo 可在 JPEG 解码阶段降采样（源图不小于 2 倍训练尺寸时），label 保持原尺寸；
+  PairedTransform/CityscapesGPUTransform 对两者各自按短边 resize 到同一尺寸，因此要求 label/photo 宽高比相同。
+  transform=None 时按原尺寸解码，label/photo 尺寸一致。
+- label PNG 用 torchvision.io 解码为 uint8 CHW tensor（libpng 直接写入 tensor，不经过 PIL）；
+  transform=None 时 label 仍以 PIL 返回，与 photo 一致（可视化、.copy() 等用法不受影响）。
+- CityscapesMemmapDataset：读取 prepare_cityscapes.py 预先 resize 好的 uint8 内存映射文件
+  `processed/{split}/{photo,label}.u8`，不再逐样本打开/解码图片。
+- transform 为 PairedTransform 时，每个 epoch 开始前调用 set_epoch(epoch)，
+  一次性为所有样本预采样 crop/flip 参数，__getitem__ 只做查表。
+- make_loader：persistent_workers + pin_memory + prefetch 的 DataLoader。训练循环中配合
+  `batch["label"].to(device, non_blocking=True)` 使 H2D 拷贝与计算重叠。
 """
 
+import json
+import os
 from pathlib import Path
-from typing import Callable, Dict, Tuple, Any, List
+from typing import Callable, Dict, Tuple, Any, List, Optional
 
+import numpy as np
+import torch
 from PIL import Image
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset
+from torchvision.io import ImageReadMode, decode_jpeg, read_image
 
+from src.data.transforms import PairedTransform, _to_uint8_tensor
 
-class CityscapesDataset(Dataset):
+# 训练时先 resize 到 286，JPEG 解码时最多降采样到不小于该尺寸
+PHOTO_DRAFT_SIZE = (286, 286)
+
+try:
+    from turbojpeg import TJPF_RGB, TurboJPEG
+
+    _turbojpeg = TurboJPEG()
+except (ImportError, RuntimeError, OSError):  # 可选依赖（use_turbojpeg）；找不到 libturbojpeg 时 TurboJPEG() 会报错
+    _turbojpeg = None
+
+
+def load_split_files(split_index: Path, split: str) -> List[str]:
+    """读取划分文件中某个 split 的文件名列表（如 '1.jpg'），支持 .npz 与 JSON 两种格式。"""
+    split_index = Path(split_index)
+    if split_index.suffix == ".npz":
+        with np.load(split_index) as splits:
+            if split not in splits.files:
+                raise ValueError(f"split '{split}' not found in {split_index}")
+            ids = splits[split]
+        return [f"{i}.jpg" for i in ids.tolist()]
+
+    with open(split_index, "r", encoding="utf-8") as f:
+        splits = json.load(f)
+    if split not in splits:
+        raise ValueError(f"split '{split}' not found in {split_index}")
+    return splits[split]
+
+
+class _PairedDataset(Dataset):
+    """两个数据集共用的 transform 调用与按 epoch 预采样的随机参数。"""
+
+    def __init__(self, transform: Optional[Callable] = None):
+        self.transform = transform
+        self._params: Optional[torch.Tensor] = None
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        为本 epoch 一次性采样全部样本的随机参数（需在遍历 DataLoader 之前调用）。
+
+        参数放在共享内存中并原地更新，persistent_workers 的子进程也能看到新 epoch 的参数。
+        未调用时 transform 逐样本自行采样。
+        """
+        if not isinstance(self.transform, PairedTransform):
+            return
+        generator = torch.Generator().manual_seed(torch.initial_seed() + epoch)
+        params = self.transform.sample_params(len(self), generator=generator)
+        if self._params is None:
+            self._params = params.share_memory_()
+        else:
+            self._params.copy_(params)
+
+    def _load(self, idx: int) -> Tuple[Any, Any]:
+        """返回第 idx 个样本解码后、变换前的 (label, photo)。"""
+        raise NotImplementedError
+
+    def _apply_transform(self, idx: int, label: Any, photo: Any) -> Tuple[Any, Any]:
+        if not self.transform:
+            return label, photo
+        if self._params is not None:
+            return self.transform(label, photo, params=self._params[idx])
+        return self.transform(label, photo)
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        label, photo = self._apply_transform(idx, *self._load(idx))
+        return {"label": label, "photo": photo, "name": self.files[idx]}
+
+
+class CityscapesDataset(_PairedDataset):
     def __init__(
         self,
         root: Path,
         split: str,
         split_index: Path,
-        transform: Callable[[Image.Image, Image.Image], Tuple[Any, Any]] = None,
+        transform: Callable[[torch.Tensor, Any], Tuple[Any, Any]] = None,
+        gpu_decode: bool = False,
+        use_turbojpeg: bool = False,
     ):
         """
         Args:
             root: 数据根目录，期望包含 processed/{split}/{photo,label}
             split: "train" 或 "val"
-            split_index: 划分文件 JSON，包含 train/val 文件名列表
-            transform: 可调用，接收 (label_img, photo_img) 返回 (label_t, photo_t)
+            split_index: 划分文件，.npz（train/val 的 int32 图像 id）或 JSON（train/val 文件名列表）
+            transform: 可调用，接收 (label_t, photo_img) 返回 (label_t, photo_t)；
+                label 为 uint8 CHW tensor，photo 为 PIL Image
+                （use_turbojpeg 时为 uint8 CHW tensor，gpu_decode 时为 CUDA tensor）。
+                为 None 时 label/photo 均以原尺寸 PIL Image 返回
+            gpu_decode: 若为 True，photo 用 nvJPEG 在 GPU 上解码为 uint8 CHW tensor；
+                CUDA 不能在 DataLoader 子进程中使用，需配合 num_workers=0。
+                原始输出固定为 PIL，因此不能与 transform=None 同时使用
+            use_turbojpeg: 若为 True，photo 用 PyTurboJPEG 解码（需安装 PyTurboJPEG 与系统 libturbojpeg）
         """
+        if gpu_decode and not torch.cuda.is_available():
+            raise RuntimeError("gpu_decode=True requires a CUDA device")
+        if gpu_decode and transform is None:
+            raise ValueError("gpu_decode=True requires a transform; raw samples (transform=None) are PIL images")
+        if use_turbojpeg and _turbojpeg is None:
+            raise RuntimeError("use_turbojpeg=True requires PyTurboJPEG and libturbojpeg")
+
+        super().__init__(transform)
         self.root = Path(root)
         self.split = split
-        self.transform = transform
+        self.gpu_decode = gpu_decode
+        self.use_turbojpeg = use_turbojpeg
 
-        import json
+        self.files: List[str] = load_split_files(split_index, split)
+        # 目录只构造一次 Path，之后按 str 处理，避免逐文件创建 PosixPath
+        self.photo_dir = os.fspath(self.root / "processed" / split / "photo")
+        self.label_dir = os.fspath(self.root / "processed" / split / "label")
 
-        with open(split_index, "r", encoding="utf-8") as f:
-            splits = json.load(f)
-        if split not in splits:
-            raise ValueError(f"split '{split}' not found in {split_index}")
-
-        self.files: List[str] = splits[split]
-        self.photo_dir = self.root / "processed" / split / "photo"
-        self.label_dir = self.root / "processed" / split / "label"
+        # 路径一次性生成，__getitem__ 只做列表索引
+        stems = [os.path.splitext(n)[0] for n in self.files]
+        self.photo_paths: List[str] = [os.path.join(self.photo_dir, f"{s}_photo.jpg") for s in stems]
+        self.label_paths: List[str] = [os.path.join(self.label_dir, f"{s}_label.png") for s in stems]
 
     def __len__(self) -> int:
         return len(self.files)
 
-    def __getitem__(self, idx: int) -> Dict[str, Any]:
-        name = self.files[idx]
-        stem = Path(name).stem
-        photo_path = self.photo_dir / f"{stem}_photo.jpg"
-        label_path = self.label_dir / f"{stem}_label.png"
+    def _load(self, idx: int) -> Tuple[Any, Any]:
+        photo_path = self.photo_paths[idx]
+        label_path = self.label_paths[idx]
+        # 只有后续会 resize 时才在解码阶段降采样；原始输出保持 label/photo 同尺寸
+        downscale = self.transform is not None
+
+        if self.gpu_decode:
+            with open(photo_path, "rb") as f:
+                data = torch.frombuffer(bytearray(f.read()), dtype=torch.uint8)
+            photo = decode_jpeg(data, mode=ImageReadMode.RGB, device="cuda")
+        elif self.use_turbojpeg:
+            with open(photo_path, "rb") as f:
+                data = f.read()
+            # 源图短边不小于 2 倍训练尺寸时解码阶段直接 1/2 降采样
+            width, height, _, _ = _turbojpeg.decode_header(data)
+            scale = (1, 2) if downscale and min(width, height) >= 2 * PHOTO_DRAFT_SIZE[0] else (1, 1)
+            photo_np = _turbojpeg.decode(data, pixel_format=TJPF_RGB, scaling_factor=scale)
+            photo = torch.from_numpy(photo_np).permute(2, 0, 1) if downscale else Image.fromarray(photo_np)
+        else:
+            photo = Image.open(photo_path)
+            if downscale:
+                # libjpeg(-turbo) 在 DCT 域按 1/2/4/8 降采样解码；源图不大于 286 时不生效
+                photo.draft("RGB", PHOTO_DRAFT_SIZE)
+            # 绝大多数 JPEG 已按 RGB 解码，跳过 convert 省去一次整图分配+拷贝；
+            # load() 立即解码并关闭文件句柄（与 convert 相同），不返回仍占用文件的惰性图像
+            if photo.mode != "RGB":
+                photo = photo.convert("RGB")
+            else:
+                photo.load()
+        if self.transform is None:
+            # 原始输出保持 PIL，与 photo 类型一致
+            with Image.open(label_path) as img:
+                label = img.convert("RGB")
+        else:
+            # label 由 libpng 直接解码为 uint8 CHW tensor，不经过 PIL
+            label = read_image(label_path, mode=ImageReadMode.RGB)
+        return label, photo
+
+
+class CityscapesMemmapDataset(_PairedDataset):
+    def __init__(
+        self,
+        root: Path,
+        split: str,
+        transform: Callable[[torch.Tensor, torch.Tensor], Tuple[Any, Any]] = None,
+    ):
+        """
+        Args:
+            root: 数据根目录，期望包含 processed/{split}/{photo,label}.u8 与 arena.json
+                （prepare_cityscapes.py --arena 只为 train 生成）
+            split: 通常为 "train"；arena 面向 jitter=True 的训练变换，val 请用 CityscapesDataset
+                （从 286 缩回 256 会二次重采样，与原图结果不同）
+            transform: 可调用，接收 (label_t, photo_t)（uint8 CHW tensor）返回 (label_t, photo_t)；
+                PairedTransform 则直接接收 memmap 的 uint8 ndarray 视图。
+                图像已是 286x286，build_transform(jitter=True) 中的 resize 不再改变尺寸
+        """
+        super().__init__(transform)
+        self.root = Path(root)
+        self.split = split
+
+        self.split_dir = self.root / "processed" / split
+        with open(self.split_dir / "arena.json", "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.files: List[str] = index["files"]
+        self.size: int = index["size"]
+
+        # 延迟到 DataLoader 子进程中再打开，避免 memmap 随 Dataset 被 pickle
+        self._photos = None
+        self._labels = None
+
+    def _open(self) -> None:
+        shape = (len(self.files), 3, self.size, self.size)
+        self._photos = np.memmap(self.split_dir / "photo.u8", dtype=np.uint8, mode="r", shape=shape)
+        self._labels = np.memmap(self.split_dir / "label.u8", dtype=np.uint8, mode="r", shape=shape)
+
+    def __len__(self) -> int:
+        return len(self.files)
 
-        photo = Image.open(photo_path).convert("RGB")
-        label = Image.open(label_path).convert("RGB")
+    def _load(self, idx: int) -> Tuple[Any, Any]:
+        if self._photos is None:
+            self._open()
+        label, photo = self._labels[idx], self._photos[idx]
+        # PairedTransform 直接从 memmap 视图裁剪（不拷贝）；其他情况先拷贝为 tensor
+        if not isinstance(self.transform, PairedTransform):
+            return _to_uint8_tensor(label), _to_uint8_tensor(photo)
+        return label, photo
 
-        if self.transform:
-            label, photo = self.transform(label, photo)
 
-        return {"label": label, "photo": photo, "name": name}
+def make_loader(
+    ds: Dataset,
+    batch_size: int,
+    shuffle: bool,
+    num_workers: int,
+    pin_memory: bool = True,
+) -> DataLoader:
+    """
+    构造 DataLoader：worker 跨 epoch 常驻（避免每个 epoch 重新 fork 与 import），
+    pinned memory 上的 batch 可在训练循环中 `.to(device, non_blocking=True)` 异步拷贝。
 
+    训练集（shuffle=True）丢弃最后不满的 batch。
+    gpu_decode 产生的 CUDA tensor 不能 pin，需传 pin_memory=False。
+    """
+    return DataLoader(
+        ds,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=2 if num_workers > 0 else None,
+        drop_last=shuffle,
+    )
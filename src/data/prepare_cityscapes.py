@@ -4,22 +4,34 @@ Cityscapes 拼接图像分割脚本。
 功能：
 1. 读取 `data/raw/cityscapes/{train,val}` 下的拼接 JPG（左：photo，右：label）。
 2. 分割并保存到 `data/processed/{split}/photo` 与 `data/processed/{split}/label`。
-3. 生成划分索引文件 `data/splits/cityscapes_split_seed42.json`（仅 train/val）。
+3. 生成划分索引文件 `data/splits/cityscapes_split_seed42.json`（仅 train/val 文件名列表；
+   传 .npz 路径则写出压缩的 int32 图像 id）。
+4. （可选，--arena）将 train split 预先 resize 到 286x286，写成连续的 uint8 CHW 内存映射文件
+   `data/processed/train/{photo,label}.u8` 及索引 `arena.json`，供 CityscapesMemmapDataset 使用。
+   限制：
+   - 只写 train：arena 面向 jitter=True 的训练变换（286 -> 随机裁剪 256）；val 若从 286 再缩回 256
+     会被重采样两次，与 CityscapesDataset 的结果不一致，因此 val 应继续使用 CityscapesDataset；
+   - 源图必须是正方形（Cityscapes 每半边为 256x256），否则直接缩放到 size x size 会改变宽高比；
+   - 约 1.5 GB，且会使预处理时间翻倍，默认不写；已存在且与当前文件列表一致时跳过（--overwrite 强制重写）。
 
 用法：
 python src/data/prepare_cityscapes.py
     --raw-dir data/raw/cityscapes
     --out-dir data/processed
     --split-file data/splits/cityscapes_split_seed42.json
-    [--overwrite]
+    [--overwrite] [--arena] [--arena-size 286] [--num-workers N]
 """
 
 import argparse
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
+import numpy as np
 from PIL import Image
+from tqdm import tqdm
 
 
 def split_and_save(
@@ -38,14 +50,86 @@ def split_and_save(
             raise ValueError(f"Image width not divisible by 2: {img_path}")
 
         mid = width // 2
-        photo = img.crop((0, 0, mid, height)).convert("RGB")
-        label = img.crop((mid, 0, width, height)).convert("RGB")
+        photo = img.crop((0, 0, mid, height))
+        if photo.mode != "RGB":
+            photo = photo.convert("RGB")
+        label = img.crop((mid, 0, width, height))
+        if label.mode != "RGB":
+            label = label.convert("RGB")
 
         photo_path.parent.mkdir(parents=True, exist_ok=True)
         label_path.parent.mkdir(parents=True, exist_ok=True)
 
         photo.save(photo_path, format="JPEG")
-        label.save(label_path, format="PNG")
+        # label 是颜色编码的类别图，保持无损 PNG；compress_level=1 大幅减少 Deflate 开销
+        label.save(label_path, format="PNG", compress_level=1)
+
+
+def _split_job(job: Tuple[Path, Path, Path, bool]) -> None:
+    split_and_save(*job)
+
+
+def _arena_job(job: Tuple[Path, Tuple[int, int, int, int], int, Path, Path]) -> None:
+    """Resize one photo/label pair and write it into slot `idx` of the arenas."""
+    split_dir, shape, idx, photo_path, label_path = job
+    size = shape[-1]
+    for name, path in (("photo.u8", photo_path), ("label.u8", label_path)):
+        arena = np.memmap(split_dir / name, dtype=np.uint8, mode="r+", shape=shape)
+        with Image.open(path) as img:
+            if img.width != img.height:
+                raise ValueError(f"Arena requires square images, got {img.size}: {path}")
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            img = img.resize((size, size), Image.BICUBIC)
+            arena[idx] = np.asarray(img).transpose(2, 0, 1)
+        arena.flush()
+
+
+def _run_parallel(fn: Callable, jobs: Sequence, num_workers: Optional[int], desc: str) -> None:
+    """Run fn over jobs in a process pool; chunksize amortizes IPC over ~8 chunks per worker."""
+    workers = num_workers or os.cpu_count() or 1
+    chunksize = max(1, len(jobs) // (workers * 8))
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        list(tqdm(ex.map(fn, jobs, chunksize=chunksize), total=len(jobs), desc=desc))
+
+
+def write_arena(
+    out_dir: Path,
+    split: str,
+    files: List[Path],
+    size: int = 286,
+    num_workers: Optional[int] = None,
+    overwrite: bool = False,
+) -> None:
+    """Write resized photo/label of a split into `{split}/{photo,label}.u8` (N x 3 x size x size, uint8)."""
+    split_dir = out_dir / split
+    shape = (len(files), 3, size, size)
+    index = {"size": size, "files": [p.name for p in files]}
+    index_path = split_dir / "arena.json"
+    if not overwrite and index_path.exists():
+        with index_path.open("r", encoding="utf-8") as f:
+            if json.load(f) == index:
+                return
+
+    # 先在主进程中分配文件，各 worker 以 r+ 打开并只写自己的 slot
+    for name in ("photo.u8", "label.u8"):
+        np.memmap(split_dir / name, dtype=np.uint8, mode="w+", shape=shape).flush()
+
+    jobs = [
+        (
+            split_dir,
+            shape,
+            idx,
+            split_dir / "photo" / f"{p.stem}_photo.jpg",
+            split_dir / "label" / f"{p.stem}_label.png",
+        )
+        for idx, p in enumerate(files)
+    ]
+    _run_parallel(_arena_job, jobs, num_workers, desc=f"{split} arena")
+
+    # 索引最后写出：中途失败时不会被误判为已完成
+    with index_path.open("w", encoding="utf-8") as f:
+        json.dump(index, f, indent=4, ensure_ascii=False)
 
 
 def collect_files(raw_dir: Path) -> Dict[str, List[Path]]:
@@ -63,22 +147,42 @@ def collect_files(raw_dir: Path) -> Dict[str, List[Path]]:
 
 
 def write_split_file(split_file: Path, splits: Dict[str, List[Path]]) -> None:
-    """Write split json using original filenames (e.g., '1.jpg')."""
+    """
+    Write the split index.
+
+    - `.npz`: one int32 array of image ids per split (e.g., '1.jpg' -> 1), compressed.
+    - otherwise: JSON lists of original filenames (e.g., '1.jpg').
+    """
     split_file.parent.mkdir(parents=True, exist_ok=True)
+    if split_file.suffix == ".npz":
+        payload = {k: np.asarray([int(p.stem) for p in v], dtype=np.int32) for k, v in splits.items()}
+        np.savez_compressed(split_file, **payload)
+        return
+
     payload = {k: [p.name for p in v] for k, v in splits.items()}
     with split_file.open("w", encoding="utf-8") as f:
         json.dump(payload, f, indent=4, ensure_ascii=False)
 
 
-def process_dataset(raw_dir: Path, out_dir: Path, overwrite: bool = False) -> Dict[str, List[Path]]:
-    """Split entire dataset and return split mapping."""
+def process_dataset(
+    raw_dir: Path,
+    out_dir: Path,
+    overwrite: bool = False,
+    arena_size: int = 0,
+    num_workers: Optional[int] = None,
+) -> Dict[str, List[Path]]:
+    """Split entire dataset in a process pool (and write the train memmap arena if arena_size > 0)."""
     splits = collect_files(raw_dir)
     for split, files in splits.items():
+        jobs = []
         for img_path in files:
             stem = img_path.stem  # e.g., "1"
             photo_path = out_dir / split / "photo" / f"{stem}_photo.jpg"
             label_path = out_dir / split / "label" / f"{stem}_label.png"
-            split_and_save(img_path, photo_path, label_path, overwrite=overwrite)
+            jobs.append((img_path, photo_path, label_path, overwrite))
+        _run_parallel(_split_job, jobs, num_workers, desc=split)
+        if arena_size > 0 and split == "train":
+            write_arena(out_dir, split, files, size=arena_size, num_workers=num_workers, overwrite=overwrite)
     return splits
 
 
@@ -100,19 +204,43 @@ def parse_args() -> argparse.Namespace:
         "--split-file",
         type=Path,
         default=Path("data/splits/cityscapes_split_seed42.json"),
-        help="Path to save split index JSON (train/val).",
+        help="Path to save split index (.json filenames, or .npz int32 ids).",
     )
     parser.add_argument(
         "--overwrite",
         action="store_true",
         help="Overwrite existing processed files.",
     )
+    parser.add_argument(
+        "--arena",
+        action="store_true",
+        help="Also write the pre-resized uint8 memmap arena for the train split.",
+    )
+    parser.add_argument(
+        "--arena-size",
+        type=int,
+        default=286,
+        help="Side length of the memmap arena (square sources only).",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=None,
+        help="Worker processes (default: os.cpu_count()).",
+    )
     return parser.parse_args()
 
 
 def main() -> None:
     args = parse_args()
-    splits = process_dataset(args.raw_dir, args.out_dir, overwrite=args.overwrite)
+    arena_size = args.arena_size if args.arena else 0
+    splits = process_dataset(
+        args.raw_dir,
+        args.out_dir,
+        overwrite=args.overwrite,
+        arena_size=arena_size,
+        num_workers=args.num_workers,
+    )
     write_split_file(args.split_file, splits)
     print("Completed processing.")
     for split, files in splits.items():
@@ -2,40 +2,204 @@
 配对图像(Label/Photo)的常用变换。
 
 提供：
-- build_transform：基础 resize/随机jitter + 随机水平翻转。
+- PairedTransform：同步 resize/随机jitter + 随机水平翻转，随机参数可由外部预采样传入。
+- build_transform：构造 PairedTransform。
 - normalize_photo：支持 tanh 模式 [-1,1] 和 0-1 模式。
+- to_uint8_pair + CityscapesGPUTransform：Dataset 只输出 uint8 tensor，
+  resize/crop/flip/归一化在 GPU 上按 batch 执行（随机参数逐样本采样，与 PairedTransform 一致）。
 
 说明：
 - label 与 photo 空间变换需同步；颜色变换仅对 photo。
+- 基于 torchvision.transforms.v2：label/photo 先转为 uint8 CHW tensor，
+  resize/crop/flip 使用同一组显式参数，全程保持 uint8（走原生 uint8 bicubic 内核），最后才转 float。
+- 输入可以是 PIL Image、uint8 CHW tensor（如 GPU 解码结果）或 uint8 CHW ndarray（如 memmap 切片）；
+  ndarray 输入无需 resize 时由 transforms_fast.crop_flip_u8 一次完成裁剪+翻转。
 """
 
-from typing import Callable, Optional, Tuple
+from typing import Optional, Tuple
 
+import numpy as np
 import torch
-import torchvision.transforms.functional as F
-from torchvision import transforms
-from PIL import Image
-import random
+import torch.nn as nn
+from torchvision.transforms import v2
+from torchvision.transforms.v2 import functional as F2
+
+from src.data.transforms_fast import crop_flip_u8
+
+_BICUBIC = v2.InterpolationMode.BICUBIC
 
 
 def normalize_photo(t: torch.Tensor, mode: str = "tanh") -> torch.Tensor:
     """
-    归一化 photo：
-    - tanh: [-1,1] => (x - 0.5) / 0.5
+    归一化 photo（原地修改 t，调用方需保证 t 是 ToDtype 新生成的 float tensor）：
+    - tanh: [-1,1] => x * 2 - 1，等价于 (x - 0.5) / 0.5
     - 01: 保持 [0,1]
     """
+    assert t.is_floating_point(), f"normalize_photo expects a float tensor, got {t.dtype}"
     if mode == "tanh":
-        return (t - 0.5) / 0.5
+        return t.mul_(2.0).sub_(1.0)
     if mode == "01":
         return t
     raise ValueError(f"Unsupported normalize mode: {mode}")
 
 
-def _random_crop_pair(label: Image.Image, photo: Image.Image, size: int) -> Tuple[Image.Image, Image.Image]:
-    i, j, h, w = transforms.RandomCrop.get_params(photo, output_size=(size, size))
-    label = F.crop(label, i, j, h, w)
-    photo = F.crop(photo, i, j, h, w)
-    return label, photo
+def _to_uint8_tensor(img) -> torch.Tensor:
+    """PIL 走 pil_to_tensor（不做 float 转换）；ndarray 拷贝为 tensor；tensor 原样返回。"""
+    if isinstance(img, torch.Tensor):
+        return img
+    if isinstance(img, np.ndarray):
+        return torch.from_numpy(np.array(img))
+    return F2.pil_to_tensor(img)
+
+
+def _build_color_jitter(factors: Optional[Tuple[float, float, float, float]]) -> Optional[v2.ColorJitter]:
+    """(brightness, contrast, saturation, hue) -> v2.ColorJitter；None 表示不做颜色抖动。"""
+    if factors is None:
+        return None
+    return v2.ColorJitter(brightness=factors[0], contrast=factors[1], saturation=factors[2], hue=factors[3])
+
+
+def _crop_origin(hw: Tuple[int, int], crop_size: int, u_i: float, u_j: float) -> Tuple[int, int]:
+    """把 [0,1) 均匀数映射为裁剪左上角，分布与 RandomCrop.get_params 相同。"""
+    h, w = hw
+    return int(u_i * (h - crop_size + 1)), int(u_j * (w - crop_size + 1))
+
+
+def _resize(img: torch.Tensor, size: int) -> torch.Tensor:
+    """短边缩放到 size；尺寸已一致时直接返回（如 286 的 memmap 输入）。"""
+    if min(img.shape[-2:]) == size:
+        return img
+    return F2.resize(img, [size], interpolation=_BICUBIC, antialias=True)
+
+
+def _finalize_pair(label: torch.Tensor, photo: torch.Tensor, normalize_mode: str) -> Tuple[torch.Tensor, torch.Tensor]:
+    """uint8 -> float [0,1]（同 ToDtype(scale=True)），仅 photo 再做归一化。"""
+    label_t = label.to(torch.float32).div_(255.0)
+    photo_t = normalize_photo(photo.to(torch.float32).div_(255.0), mode=normalize_mode)
+    return label_t, photo_t
+
+
+class PairedTransform:
+    """
+    同步的 label/photo 变换：resize -> 随机裁剪 -> 随机水平翻转 -> (photo) 颜色抖动 -> float/归一化。
+
+    所有随机性由一行 4 个 [0,1) 均匀数 (scale, crop_i, crop_j, flip) 决定：
+    - 不传 params 时每次调用自行采样；
+    - Dataset.set_epoch 可用 sample_params(N) 一次性为整个 epoch 预采样，再逐样本传入。
+
+    compile_tail=True 时用 torch.compile 编译形状固定（[3,image_size,image_size]）的收尾步骤
+    （转 float + 缩放 + 归一化），融合为单个内核；裁剪/翻转的位置逐样本变化，不参与编译。
+    编译结果不随对象 pickle，每个 DataLoader worker 在首次调用时各自编译。
+    """
+
+    NUM_PARAMS = 4
+
+    def __init__(
+        self,
+        image_size: int = 256,
+        jitter: bool = True,
+        normalize_mode: str = "tanh",
+        horizontal_flip: bool = True,
+        color_jitter: Optional[Tuple[float, float, float, float]] = None,
+        scale_range: Optional[Tuple[float, float]] = None,
+        jitter_size: int = 286,
+        compile_tail: bool = False,
+    ):
+        self.image_size = image_size
+        self.jitter = jitter
+        self.jitter_size = jitter_size
+        self.normalize_mode = normalize_mode
+        self.horizontal_flip = horizontal_flip
+        self.color_jitter_factors = color_jitter
+        self.scale_range = scale_range
+        # jitter: 先缩放到 jitter_size 再随机裁剪；否则直接缩放到 image_size
+        self.base_size = jitter_size if jitter else image_size
+        self.color_jitter = _build_color_jitter(color_jitter)
+        self.compile_tail = compile_tail
+        self._finalize = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_finalize"] = None
+        return state
+
+    def _get_finalize(self):
+        if self._finalize is None:
+            self._finalize = torch.compile(_finalize_pair, dynamic=False) if self.compile_tail else _finalize_pair
+        return self._finalize
+
+    def sample_params(self, n: int, generator: Optional[torch.Generator] = None) -> torch.Tensor:
+        """一次性采样 n 个样本的随机参数，形状 [n, NUM_PARAMS]。"""
+        return torch.rand(n, self.NUM_PARAMS, generator=generator)
+
+    def _spatial_params(self, params: torch.Tensor) -> Tuple[int, int, float, float, bool]:
+        """一行随机参数 -> (target_resize, crop_size, u_i, u_j, do_flip)。"""
+        u_scale, u_i, u_j, u_flip = params.tolist()
+
+        # 额外随机缩放（在 jitter 前进行）
+        target_resize = self.base_size
+        if self.scale_range is not None:
+            lo, hi = self.scale_range
+            target_resize = int(self.base_size * (lo + (hi - lo) * u_scale))
+        # 避免 target_resize < image_size 时随机裁剪报错
+        crop_size = min(self.image_size, target_resize)
+        do_flip = self.horizontal_flip and u_flip < 0.5
+        return target_resize, crop_size, u_i, u_j, do_flip
+
+    def _spatial(
+        self,
+        label: torch.Tensor,
+        photo: torch.Tensor,
+        target_resize: int,
+        crop_size: int,
+        u_i: float,
+        u_j: float,
+        do_flip: bool,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """uint8 CHW tensor 的同步 resize/crop/flip。"""
+        label = _resize(label, target_resize)
+        photo = _resize(photo, target_resize)
+        i, j = _crop_origin(photo.shape[-2:], crop_size, u_i, u_j)
+        label = F2.crop(label, i, j, crop_size, crop_size)
+        photo = F2.crop(photo, i, j, crop_size, crop_size)
+
+        # 若 crop_size 小于期望的 image_size，则再统一放缩到 image_size
+        if crop_size != self.image_size:
+            label = _resize(label, self.image_size)
+            photo = _resize(photo, self.image_size)
+
+        if do_flip:
+            label = F2.horizontal_flip(label)
+            photo = F2.horizontal_flip(photo)
+        return label, photo
+
+    def __call__(self, label, photo, params: Optional[torch.Tensor] = None):
+        if params is None:
+            params = self.sample_params(1)[0]
+        target_resize, crop_size, u_i, u_j, do_flip = self._spatial_params(params)
+
+        if (
+            isinstance(label, np.ndarray)
+            and isinstance(photo, np.ndarray)
+            and min(photo.shape[-2:]) == target_resize
+            and crop_size == self.image_size
+        ):
+            # uint8 ndarray（如 memmap 切片）且无需 resize：裁剪+翻转一次完成
+            i, j = _crop_origin(photo.shape[-2:], crop_size, u_i, u_j)
+            label = torch.from_numpy(crop_flip_u8(label, i, j, crop_size, do_flip))
+            photo = torch.from_numpy(crop_flip_u8(photo, i, j, crop_size, do_flip))
+        else:
+            # 同步 resize/crop/flip（uint8）
+            label, photo = self._spatial(
+                _to_uint8_tensor(label), _to_uint8_tensor(photo), target_resize, crop_size, u_i, u_j, do_flip
+            )
+
+        # 仅对 photo 做颜色抖动
+        if self.color_jitter is not None:
+            photo = self.color_jitter(photo)
+
+        # 最后才转 float，归一到 [0,1]；仅 photo 做归一化
+        return self._get_finalize()(label, photo, self.normalize_mode)
 
 
 def build_transform(
@@ -45,9 +209,10 @@ def build_transform(
     horizontal_flip: bool = True,
     color_jitter: Optional[Tuple[float, float, float, float]] = None,
     scale_range: Optional[Tuple[float, float]] = None,
-) -> Callable:
+    compile_tail: bool = False,
+) -> PairedTransform:
     """
-    返回一个可调用 transform(label, photo) -> (label_t, photo_t)。
+    返回一个可调用 transform(label, photo) -> (label_t, photo_t)（PairedTransform 实例）。
 
     参数：
     - image_size: 输出尺寸（square）。
@@ -58,75 +223,88 @@ def build_transform(
       传 None 表示不做颜色抖动；例如 (0.2, 0.2, 0.2, 0.05)。
     - scale_range: (min_scale, max_scale)，在 resize+jitter 前随机缩放，保持最长边比例；
       仅做空间缩放，label/photo 同步；传 None 则不做额外缩放。
+    - compile_tail: 是否用 torch.compile 编译转 float + 归一化的收尾步骤。
     """
-    cj_transform = (
-        transforms.ColorJitter(
-            brightness=color_jitter[0],
-            contrast=color_jitter[1],
-            saturation=color_jitter[2],
-            hue=color_jitter[3],
-        )
-        if color_jitter is not None
-        else None
+    return PairedTransform(
+        image_size=image_size,
+        jitter=jitter,
+        normalize_mode=normalize_mode,
+        horizontal_flip=horizontal_flip,
+        color_jitter=color_jitter,
+        scale_range=scale_range,
+        compile_tail=compile_tail,
     )
 
-    def _transform(label: Image.Image, photo: Image.Image):
-        # 同步 resize/jitter
-        if jitter:
-            base_size = 286
-            target_resize = base_size
-            # 额外随机缩放（在 jitter 前进行）
-            if scale_range is not None:
-                scale = random.uniform(scale_range[0], scale_range[1])
-                target_resize = int(base_size * scale)
-
-            # 先缩放到 target_resize，之后再根据需要裁剪/补缩放回 image_size
-            label = F.resize(label, target_resize, interpolation=transforms.InterpolationMode.BICUBIC)
-            photo = F.resize(photo, target_resize, interpolation=transforms.InterpolationMode.BICUBIC)
-
-            # 避免 target_resize < image_size 时随机裁剪报错
-            crop_size = min(image_size, target_resize)
-            label, photo = _random_crop_pair(label, photo, crop_size)
-
-            # 若 crop_size 小于期望的 image_size，则再统一放缩到 image_size
-            if crop_size != image_size:
-                label = F.resize(label, image_size, interpolation=transforms.InterpolationMode.BICUBIC)
-                photo = F.resize(photo, image_size, interpolation=transforms.InterpolationMode.BICUBIC)
-        else:
-            target_resize = image_size
-            if scale_range is not None:
-                scale = random.uniform(scale_range[0], scale_range[1])
-                target_resize = int(image_size * scale)
 
-            label = F.resize(label, target_resize, interpolation=transforms.InterpolationMode.BICUBIC)
-            photo = F.resize(photo, target_resize, interpolation=transforms.InterpolationMode.BICUBIC)
+def to_uint8_pair(label, photo) -> Tuple[torch.Tensor, torch.Tensor]:
+    """只转换为 uint8 CHW tensor，不做任何增强；配合 CityscapesGPUTransform 使用。"""
+    return _to_uint8_tensor(label), _to_uint8_tensor(photo)
 
-            # 裁剪尺寸不能超过当前图像尺寸
-            crop_size = min(image_size, target_resize)
-            label, photo = _random_crop_pair(label, photo, crop_size)
 
-            # 若裁剪结果尺寸小于 image_size，再放缩到统一尺寸
-            if crop_size != image_size:
-                label = F.resize(label, image_size, interpolation=transforms.InterpolationMode.BICUBIC)
-                photo = F.resize(photo, image_size, interpolation=transforms.InterpolationMode.BICUBIC)
+class CityscapesGPUTransform(nn.Module):
+    """
+    在 GPU 上对 uint8 batch [B,3,H,W] 执行与 PairedTransform 相同的变换链：
+    resize -> 随机裁剪 -> 随机水平翻转 -> (photo) 颜色抖动 -> float/归一化。
 
-        # 同步水平翻转
-        if horizontal_flip and random.random() < 0.5:
-            label = F.hflip(label)
-            photo = F.hflip(photo)
+    随机参数用 PairedTransform.sample_params(B) 逐样本采样：每个样本有各自的裁剪位置、翻转与颜色抖动，
+    与 CPU 路径的增强分布一致。无 scale_range 时整个 batch 先一次 resize 到同一尺寸，
+    之后逐样本裁剪/翻转（切片视图）并 stack；有 scale_range 时各样本尺寸不同，逐样本 resize。
 
-        # 仅对 photo 做颜色抖动
-        if cj_transform is not None:
-            photo = cj_transform(photo)
+    用法：
+        gpu_tf = CityscapesGPUTransform.from_paired(build_transform(...)).to(device)
+        label, photo = gpu_tf(batch["label"].to(device, non_blocking=True),
+                              batch["photo"].to(device, non_blocking=True))
+    """
 
-        # 转 tensor
-        label_t = F.to_tensor(label)  # 归一到 [0,1]
-        photo_t = F.to_tensor(photo)
+    def __init__(
+        self,
+        image_size: int = 256,
+        jitter: bool = True,
+        normalize_mode: str = "tanh",
+        horizontal_flip: bool = True,
+        color_jitter: Optional[Tuple[float, float, float, float]] = None,
+        scale_range: Optional[Tuple[float, float]] = None,
+        jitter_size: int = 286,
+    ):
+        super().__init__()
+        # 参数采样与单样本空间变换复用 PairedTransform，保证两条路径一致
+        self.paired = PairedTransform(
+            image_size=image_size,
+            jitter=jitter,
+            normalize_mode=normalize_mode,
+            horizontal_flip=horizontal_flip,
+            color_jitter=color_jitter,
+            scale_range=scale_range,
+            jitter_size=jitter_size,
+        )
 
-        # 仅 photo 做归一化
-        photo_t = normalize_photo(photo_t, mode=normalize_mode)
+    @classmethod
+    def from_paired(cls, transform: PairedTransform) -> "CityscapesGPUTransform":
+        """按 PairedTransform 的配置构造等价的 GPU 变换。"""
+        return cls(
+            image_size=transform.image_size,
+            jitter=transform.jitter,
+            normalize_mode=transform.normalize_mode,
+            horizontal_flip=transform.horizontal_flip,
+            color_jitter=transform.color_jitter_factors,
+            scale_range=transform.scale_range,
+            jitter_size=transform.jitter_size,
+        )
 
-        return label_t, photo_t
+    def forward(self, label: torch.Tensor, photo: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        paired = self.paired
+        params = paired.sample_params(label.shape[0])
+        if paired.scale_range is None:
+            # 所有样本的 resize 目标相同：整个 batch 一次完成，逐样本时 _resize 直接跳过
+            label = _resize(label, paired.base_size)
+            photo = _resize(photo, paired.base_size)
 
-    return _transform
+        labels, photos = [], []
+        for b in range(label.shape[0]):
+            label_b, photo_b = paired._spatial(label[b], photo[b], *paired._spatial_params(params[b]))
+            if paired.color_jitter is not None:
+                photo_b = paired.color_jitter(photo_b)
+            labels.append(label_b)
+            photos.append(photo_b)
 
+        return _finalize_pair(torch.stack(labels), torch.stack(photos), paired.normalize_mode)
@@ -0,0 +1,44 @@
+"""
+uint8 CHW 数组的融合裁剪 + 水平翻转。
+
+- 安装了 numba 时使用 @njit 内核，一次遍历直接写出结果；
+  内核为单线程：DataLoader 已按 worker 进程并行，parallel=True 会造成线程超订，
+  且在 TBB 线程层下 fork 出的 worker 可能卡死；
+- 否则退化为 numpy 的 strided view + np.ascontiguousarray（同样只拷贝一次）。
+
+供 PairedTransform 在输入为 uint8 ndarray（如 memmap 切片）且无需 resize 时使用。
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba 为可选依赖
+    njit = None
+
+
+if njit is not None:
+
+    @njit(cache=True)
+    def _crop_flip_kernel(src, out, i, j, do_flip):
+        C, H, W = out.shape
+        for y in range(H):
+            for c in range(C):
+                for x in range(W):
+                    sx = W - 1 - x if do_flip else x
+                    out[c, y, x] = src[c, i + y, j + sx]
+
+
+def crop_flip_u8(src: np.ndarray, i: int, j: int, size: int, do_flip: bool) -> np.ndarray:
+    """从 src[:, i:i+size, j:j+size] 裁剪（可选水平翻转），返回新的连续 uint8 数组。"""
+    # memmap 等 ndarray 子类转为普通视图（不拷贝）
+    src = np.asarray(src)
+    if njit is not None:
+        out = np.empty((src.shape[0], size, size), dtype=np.uint8)
+        _crop_flip_kernel(src, out, i, j, do_flip)
+        return out
+
+    view = src[:, i:i + size, j:j + size]
+    if do_flip:
+        view = view[:, :, ::-1]
+    return np.ascontiguousarray(view)
@@ -0,0 +1,155 @@
+"""
+将已分割的 Cityscapes label/photo 打包为 FFCV `.beton`，并提供对应的 loader。
+
+- 写出：每个样本一条记录 {label, photo, name}，图像以 raw RGB 存储（无损、读取时无需解码）。
+- 读取：CityscapesFFCVLoader 按顺序流式读取 `.beton`，只做解码 + 拷贝到 GPU；
+  label/photo 的同步 resize/crop/flip/归一化交给 CityscapesGPUTransform。
+  FFCV 自带的 RandomResizedCrop/RandomHorizontalFlip 对每个字段独立采样，不能用于配对数据。
+
+用法：
+python src/data/write_ffcv.py
+    --data-root data
+    --split-index data/splits/cityscapes_split_seed42.json
+    --split train
+    --out data/processed/train.beton
+"""
+
+import argparse
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+import torch
+from ffcv.fields import BytesField, RGBImageField
+from ffcv.fields.decoders import SimpleRGBImageDecoder
+from ffcv.loader import Loader, OrderOption
+from ffcv.transforms import ToDevice, ToTensor, ToTorchImage
+from ffcv.writer import DatasetWriter
+
+from src.data.dataset import CityscapesDataset
+from src.data.transforms import CityscapesGPUTransform
+
+
+def _to_hwc(img) -> np.ndarray:
+    """CHW tensor（可在 GPU 上）或 PIL 图像转为连续的 HWC uint8 数组。"""
+    if isinstance(img, torch.Tensor):
+        return np.ascontiguousarray(img.permute(1, 2, 0).cpu().numpy())
+    return np.asarray(img)
+
+
+class _FFCVSource:
+    """把 CityscapesDataset(transform=None) 的样本转为 FFCV 需要的 (HWC uint8, HWC uint8, bytes) 元组。"""
+
+    def __init__(self, dataset: CityscapesDataset):
+        self.dataset = dataset
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, idx: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        sample = self.dataset[idx]
+        label = _to_hwc(sample["label"])
+        photo = _to_hwc(sample["photo"])
+        name = np.frombuffer(sample["name"].encode("utf-8"), dtype=np.uint8)
+        return label, photo, name
+
+
+def write_beton(
+    data_root: Path,
+    split_index: Path,
+    split: str,
+    out_path: Path,
+    num_workers: int = -1,
+) -> None:
+    """Write one split of CityscapesDataset into an FFCV .beton file."""
+    dataset = CityscapesDataset(root=data_root, split=split, split_index=split_index, transform=None)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    writer = DatasetWriter(
+        str(out_path),
+        {
+            "label": RGBImageField(write_mode="raw"),
+            "photo": RGBImageField(write_mode="raw"),
+            "name": BytesField(),
+        },
+        num_workers=num_workers,
+    )
+    writer.from_indexed_dataset(_FFCVSource(dataset))
+
+
+class CityscapesFFCVLoader:
+    """
+    `.beton` 上的 FFCV Loader，迭代产出与 CityscapesDataset + DataLoader 相同格式的 batch：
+    {"label": [B,3,H,W], "photo": [B,3,H,W]}（已在 device 上完成变换）。
+    """
+
+    def __init__(
+        self,
+        beton_path: Path,
+        batch_size: int,
+        device: torch.device,
+        num_workers: int = 8,
+        shuffle: bool = True,
+        gpu_transform: Optional[CityscapesGPUTransform] = None,
+    ):
+        """
+        Args:
+            beton_path: write_beton 写出的文件
+            batch_size: batch 大小
+            device: 解码后拷贝到的设备
+            num_workers: FFCV 解码线程数
+            shuffle: True 时随机顺序并丢弃最后不满的 batch
+            gpu_transform: 在 device 上执行的同步变换；None 时输出 uint8 tensor
+        """
+        self.gpu_transform = gpu_transform
+
+        def image_pipeline():
+            return [
+                SimpleRGBImageDecoder(),
+                ToTensor(),
+                ToDevice(device, non_blocking=True),
+                ToTorchImage(),
+            ]
+
+        self.loader = Loader(
+            str(beton_path),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            order=OrderOption.RANDOM if shuffle else OrderOption.SEQUENTIAL,
+            drop_last=shuffle,
+            pipelines={"label": image_pipeline(), "photo": image_pipeline(), "name": None},
+        )
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        for label, photo in self.loader:
+            if self.gpu_transform is not None:
+                label, photo = self.gpu_transform(label, photo)
+            yield {"label": label, "photo": photo}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Write Cityscapes label/photo pairs to an FFCV .beton file.")
+    parser.add_argument("--data-root", type=Path, default=Path("data"), help="Data root directory.")
+    parser.add_argument(
+        "--split-index",
+        type=Path,
+        default=Path("data/splits/cityscapes_split_seed42.json"),
+        help="Split index (.json or .npz).",
+    )
+    parser.add_argument("--split", type=str, default="train", choices=["train", "val"])
+    parser.add_argument("--out", type=Path, default=None, help="Output path (default: data/processed/{split}.beton).")
+    parser.add_argument("--num-workers", type=int, default=-1, help="Writer processes (-1: all CPUs).")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    out_path = args.out or args.data_root / "processed" / f"{args.split}.beton"
+    write_beton(args.data_root, args.split_index, args.split, out_path, num_workers=args.num_workers)
+    print(f"Wrote {out_path}")
+
+
+if __name__ == "__main__":
+    main()
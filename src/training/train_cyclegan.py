@@ -28,7 +28,6 @@ from datetime import datetime
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 import numpy as np
@@ -36,8 +35,8 @@ from PIL import Image
 
 from src.models.cyclegan_generator import CycleGANGenerator
 from src.models.cyclegan_discriminator import CycleGANDiscriminator
-from src.data.dataset import CityscapesDataset
-from src.data.transforms import build_transform
+from src.data.dataset import CityscapesDataset, make_loader
+from src.data.transforms import CityscapesGPUTransform, build_transform, to_uint8_pair
 from src.eval.metrics import evaluate_batch
 
 
@@ -119,7 +118,7 @@ def train_epoch(
     optimizer_G, optimizer_F,
     optimizer_D_photo, optimizer_D_label,
     device, epoch, lambda_cycle=10.0, lambda_identity=0.5,
-    writer=None
+    writer=None, gpu_transform=None
 ):
     """训练一个epoch"""
     generator_G.train()
@@ -136,8 +135,10 @@ def train_epoch(
     
     pbar = tqdm(dataloader, desc=f"Epoch {epoch} [Train]")
     for batch_idx, batch in enumerate(pbar):
-        label = batch["label"].to(device)
-        photo = batch["photo"].to(device)
+        label = batch["label"].to(device, non_blocking=True)
+        photo = batch["photo"].to(device, non_blocking=True)
+        if gpu_transform is not None:
+            label, photo = gpu_transform(label, photo)
         
         batch_size = label.size(0)
         
@@ -269,7 +270,7 @@ def train_epoch(
 def validate(
     generator_G, generator_F,
     dataloader, l1_loss, device, epoch, output_dir,
-    writer=None, num_samples=10
+    writer=None, num_samples=10, gpu_transform=None
 ):
     """验证并保存三联图"""
     generator_G.eval()
@@ -282,8 +283,10 @@ def validate(
     
     pbar = tqdm(dataloader, desc=f"Epoch {epoch} [Val]")
     for batch_idx, batch in enumerate(pbar):
-        label = batch["label"].to(device)
-        photo = batch["photo"].to(device)
+        label = batch["label"].to(device, non_blocking=True)
+        photo = batch["photo"].to(device, non_blocking=True)
+        if gpu_transform is not None:
+            label, photo = gpu_transform(label, photo)
         name = batch["name"]
         
         # 前向传播
@@ -381,6 +384,10 @@ def main():
     parser.add_argument("--num-val-samples", type=int, default=10, help="Number of validation samples to save")
     parser.add_argument("--save-interval", type=int, default=10, help="Save checkpoint every N epochs")
     parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--gpu-decode", action="store_true", help="Decode photo JPEGs on GPU via nvJPEG (forces num_workers=0)")
+    parser.add_argument("--turbojpeg", action="store_true", help="Decode photo JPEGs with PyTurboJPEG (requires libturbojpeg)")
+    parser.add_argument("--gpu-transform", action="store_true", help="Run resize/crop/flip/normalize on GPU per batch")
+    parser.add_argument("--compile-transform", action="store_true", help="torch.compile the fixed-shape float/normalize tail of the CPU transform")
     
     args = parser.parse_args()
     
@@ -408,7 +415,8 @@ def main():
         horizontal_flip=True,
         color_jitter=None,
         scale_range=None,
-        normalize_mode="tanh"
+        normalize_mode="tanh",
+        compile_tail=args.compile_transform
     )
     val_transform = build_transform(
         image_size=256,
@@ -416,37 +424,53 @@ def main():
         horizontal_flip=False,
         color_jitter=None,
         scale_range=None,
-        normalize_mode="tanh"
+        normalize_mode="tanh",
+        compile_tail=args.compile_transform
     )
     
+    # GPU 变换：Dataset 只输出 uint8 tensor，增强在 GPU 上按 batch 执行
+    train_gpu_transform = val_gpu_transform = None
+    if args.gpu_transform:
+        train_gpu_transform = CityscapesGPUTransform.from_paired(train_transform).to(device)
+        val_gpu_transform = CityscapesGPUTransform.from_paired(val_transform).to(device)
+        train_transform = val_transform = to_uint8_pair
+    
     # 加载数据集
     print("Loading datasets...")
     train_dataset = CityscapesDataset(
         root=args.data_root,
         split="train",
         split_index=args.split_index,
-        transform=train_transform
+        transform=train_transform,
+        gpu_decode=args.gpu_decode,
+        use_turbojpeg=args.turbojpeg
     )
     val_dataset = CityscapesDataset(
         root=args.data_root,
         split="val",
         split_index=args.split_index,
-        transform=val_transform
+        transform=val_transform,
+        gpu_decode=args.gpu_decode,
+        use_turbojpeg=args.turbojpeg
     )
     
-    train_loader = DataLoader(
+    # GPU 解码产生的 CUDA tensor 不能在子进程中创建，也不能 pin
+    num_workers = 0 if args.gpu_decode else 2
+    pin_memory = device.type == "cuda" and not args.gpu_decode
+
+    train_loader = make_loader(
         train_dataset,
         batch_size=args.batch_size,
         shuffle=True,
-        num_workers=2,
-        pin_memory=True if device.type == "cuda" else False
+        num_workers=num_workers,
+        pin_memory=pin_memory
     )
-    val_loader = DataLoader(
+    val_loader = make_loader(
         val_dataset,
         batch_size=args.batch_size,
         shuffle=False,
-        num_workers=2,
-        pin_memory=True if device.type == "cuda" else False
+        num_workers=num_workers,
+        pin_memory=pin_memory
     )
     
     print(f"Train samples: {len(train_dataset)}, Val samples: {len(val_dataset)}")
@@ -506,6 +530,9 @@ def main():
     best_val_psnr = 0.0
     
     for epoch in range(1, args.epochs + 1):
+        # 为本 epoch 预采样 crop/flip 参数
+        train_dataset.set_epoch(epoch)
+
         # 训练
         train_losses = train_epoch(
             generator_G, generator_F,
@@ -516,14 +543,16 @@ def main():
             device, epoch,
             lambda_cycle=args.lambda_cycle,
             lambda_identity=args.lambda_identity,
-            writer=writer
+            writer=writer,
+            gpu_transform=train_gpu_transform
         )
         
         # 验证
         val_loss_cycle, val_metrics = validate(
             generator_G, generator_F,
             val_loader, l1_loss, device, epoch, exp_dir,
-            writer=writer, num_samples=args.num_val_samples
+            writer=writer, num_samples=args.num_val_samples,
+            gpu_transform=val_gpu_transform
         )
         
         # 学习率调度
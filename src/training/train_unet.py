@@ -18,15 +18,14 @@ from datetime import datetime
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 import numpy as np
 from PIL import Image
 
 from src.models.unet_baseline import UNetBaseline
-from src.data.dataset import CityscapesDataset
-from src.data.transforms import build_transform
+from src.data.dataset import CityscapesDataset, make_loader
+from src.data.transforms import CityscapesGPUTransform, build_transform, to_uint8_pair
 
 
 def save_triplet(label, generated, ground_truth, save_path):
@@ -53,7 +52,7 @@ def save_triplet(label, generated, ground_truth, save_path):
     Image.fromarray(triplet).save(save_path)
 
 
-def train_epoch(model, dataloader, criterion, optimizer, device, epoch, writer=None):
+def train_epoch(model, dataloader, criterion, optimizer, device, epoch, writer=None, gpu_transform=None):
     """训练一个epoch"""
     model.train()
     total_loss = 0.0
@@ -61,8 +60,10 @@ def train_epoch(model, dataloader, criterion, optimizer, device, epoch, writer=N
     
     pbar = tqdm(dataloader, desc=f"Epoch {epoch} [Train]")
     for batch_idx, batch in enumerate(pbar):
-        label = batch["label"].to(device)
-        photo = batch["photo"].to(device)
+        label = batch["label"].to(device, non_blocking=True)
+        photo = batch["photo"].to(device, non_blocking=True)
+        if gpu_transform is not None:
+            label, photo = gpu_transform(label, photo)
         
         # 前向传播
         optimizer.zero_grad()
@@ -89,7 +90,7 @@ def train_epoch(model, dataloader, criterion, optimizer, device, epoch, writer=N
 
 
 @torch.no_grad()
-def validate(model, dataloader, criterion, device, epoch, output_dir, writer=None, num_samples=10):
+def validate(model, dataloader, criterion, device, epoch, output_dir, writer=None, num_samples=10, gpu_transform=None):
     """验证并保存三联图"""
     model.eval()
     total_loss = 0.0
@@ -98,8 +99,10 @@ def validate(model, dataloader, criterion, device, epoch, output_dir, writer=Non
     
     pbar = tqdm(dataloader, desc=f"Epoch {epoch} [Val]")
     for batch_idx, batch in enumerate(pbar):
-        label = batch["label"].to(device)
-        photo = batch["photo"].to(device)
+        label = batch["label"].to(device, non_blocking=True)
+        photo = batch["photo"].to(device, non_blocking=True)
+        if gpu_transform is not None:
+            label, photo = gpu_transform(label, photo)
         name = batch["name"]
         
         # 前向传播
@@ -160,6 +163,10 @@ def main():
     parser.add_argument("--num-val-samples", type=int, default=10, help="Number of validation samples to save")
     parser.add_argument("--save-interval", type=int, default=10, help="Save checkpoint every N epochs")
     parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--gpu-decode", action="store_true", help="Decode photo JPEGs on GPU via nvJPEG (forces num_workers=0)")
+    parser.add_argument("--turbojpeg", action="store_true", help="Decode photo JPEGs with PyTurboJPEG (requires libturbojpeg)")
+    parser.add_argument("--gpu-transform", action="store_true", help="Run resize/crop/flip/normalize on GPU per batch")
+    parser.add_argument("--compile-transform", action="store_true", help="torch.compile the fixed-shape float/normalize tail of the CPU transform")
     
     args = parser.parse_args()
     
@@ -188,7 +195,8 @@ def main():
             horizontal_flip=False,
             color_jitter=None,
             scale_range=None,
-            normalize_mode="tanh"
+            normalize_mode="tanh",
+            compile_tail=args.compile_transform
         ),
         "basic": build_transform(
             image_size=256,
@@ -196,7 +204,8 @@ def main():
             horizontal_flip=True,
             color_jitter=None,
             scale_range=None,
-            normalize_mode="tanh"
+            normalize_mode="tanh",
+            compile_tail=args.compile_transform
         ),
         "strong": build_transform(
             image_size=256,
@@ -204,41 +213,57 @@ def main():
             horizontal_flip=True,
             color_jitter=(0.2, 0.2, 0.2, 0.05),
             scale_range=(0.8, 1.2),
-            normalize_mode="tanh"
+            normalize_mode="tanh",
+            compile_tail=args.compile_transform
         ),
     }
     
     train_transform = aug_configs[args.aug_mode]
     val_transform = aug_configs["none"]  # 验证集不使用增强
     
+    # GPU 变换：Dataset 只输出 uint8 tensor，增强在 GPU 上按 batch 执行
+    train_gpu_transform = val_gpu_transform = None
+    if args.gpu_transform:
+        train_gpu_transform = CityscapesGPUTransform.from_paired(train_transform).to(device)
+        val_gpu_transform = CityscapesGPUTransform.from_paired(val_transform).to(device)
+        train_transform = val_transform = to_uint8_pair
+    
     # 加载数据集
     print("Loading datasets...")
     train_dataset = CityscapesDataset(
         root=args.data_root,
         split="train",
         split_index=args.split_index,
-        transform=train_transform
+        transform=train_transform,
+        gpu_decode=args.gpu_decode,
+        use_turbojpeg=args.turbojpeg
     )
     val_dataset = CityscapesDataset(
         root=args.data_root,
         split="val",
         split_index=args.split_index,
-        transform=val_transform
+        transform=val_transform,
+        gpu_decode=args.gpu_decode,
+        use_turbojpeg=args.turbojpeg
     )
     
-    train_loader = DataLoader(
+    # GPU 解码产生的 CUDA tensor 不能在子进程中创建，也不能 pin
+    num_workers = 0 if args.gpu_decode else 2
+    pin_memory = device.type == "cuda" and not args.gpu_decode
+
+    train_loader = make_loader(
         train_dataset,
         batch_size=args.batch_size,
         shuffle=True,
-        num_workers=2,
-        pin_memory=True if device.type == "cuda" else False
+        num_workers=num_workers,
+        pin_memory=pin_memory
     )
-    val_loader = DataLoader(
+    val_loader = make_loader(
         val_dataset,
         batch_size=args.batch_size,
         shuffle=False,
-        num_workers=2,
-        pin_memory=True if device.type == "cuda" else False
+        num_workers=num_workers,
+        pin_memory=pin_memory
     )
     
     print(f"Train samples: {len(train_dataset)}, Val samples: {len(val_dataset)}")
@@ -261,11 +286,14 @@ def main():
     best_val_loss = float("inf")
     
     for epoch in range(1, args.epochs + 1):
+        # 为本 epoch 预采样 crop/flip 参数
+        train_dataset.set_epoch(epoch)
+
         # 训练
-        train_loss = train_epoch(model, train_loader, criterion, optimizer, device, epoch, writer)
+        train_loss = train_epoch(model, train_loader, criterion, optimizer, device, epoch, writer, train_gpu_transform)
         
         # 验证
-        val_loss = validate(model, val_loader, criterion, device, epoch, exp_dir, writer, args.num_val_samples)
+        val_loss = validate(model, val_loader, criterion, device, epoch, exp_dir, writer, args.num_val_samples, val_gpu_transform)
         
         # 学习率调度
         scheduler.step()